@@ -1,98 +1,201 @@
 import mido
 import sounddevice as sd
 import numpy as np
+import heapq
+import math
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional; generate_nes_pluck falls back to NumPy without it
+    njit = None
+
+# Lookup tables for the 128 MIDI note numbers
+_NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+_FREQ_TABLE = 440.0 * 2.0 ** ((np.arange(128) - 69) / 12.0)
+_NAME_TABLE = [f"{_NOTE_NAMES[n % 12]}{(n // 12) - 1}" for n in range(128)]
+_NAME_ARRAY = np.array(_NAME_TABLE)
+
+# MIDI events flattened into arrays by midi_to_c_hex
+_SET_TEMPO, _NOTE_ON, _NOTE_OFF = 1, 2, 3
+_EVENT_KINDS = {'set_tempo': _SET_TEMPO, 'note_on': _NOTE_ON, 'note_off': _NOTE_OFF}
+_EVENT_DTYPE = [('time', 'i8'), ('type', 'u1'), ('note', 'u1'), ('vel', 'u1'), ('tempo', 'i8')]
+
+# Notes returned by midi_to_c_hex, one record per note
+NOTE_DTYPE = [('start_ms', 'i4'), ('freq', 'i4'), ('dur', 'i4'), ('note', 'u1'), ('vel', 'u1')]
 
 def midi_note_to_frequency(note):
     """Convert MIDI note number to frequency in Hz"""
-    return 440.0 * (2.0 ** ((note - 69) / 12.0))
+    return _FREQ_TABLE[note]
 
 def midi_note_to_name(note):
     """Convert MIDI note number to note name"""
-    note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-    octave = (note // 12) - 1
-    note_name = note_names[note % 12]
-    return f"{note_name}{octave}"
+    return _NAME_TABLE[note]
 
 def midi_to_c_hex(midi_file, tempo_override=None):
     """Convert MIDI file to C hex array format"""
     mid = mido.MidiFile(midi_file)
     
-    notes = []
     tempo = 500000  # Default tempo (microseconds per beat)
     ticks_per_beat = mid.ticks_per_beat
     
+    # Per-track note arrays, seeded empty so concatenation always works
+    starts = [np.zeros(0, dtype=np.int64)]
+    durations = [np.zeros(0, dtype=np.int64)]
+    pitches = [np.zeros(0, dtype=np.uint8)]
+    velocities = [np.zeros(0, dtype=np.uint8)]
+    
     # Extract notes and timing with proper duration tracking
     for track in mid.tracks:
-        current_time = 0
-        active_notes = {}  # Track note_on events with velocity
+        # Flatten the track once; everything after this is array operations
+        events = np.array(
+            [(msg.time, _EVENT_KINDS.get(msg.type, 0), getattr(msg, 'note', 0),
+              getattr(msg, 'velocity', 0), getattr(msg, 'tempo', 0)) for msg in track],
+            dtype=_EVENT_DTYPE)
+        times = np.cumsum(events['time'])
+        index = np.arange(len(events))
+        
+        # Tempo in effect at each event; before the track's first set_tempo
+        # the last tempo seen in earlier tracks still applies
+        is_tempo = events['type'] == _SET_TEMPO
+        last_tempo = np.maximum.accumulate(np.where(is_tempo, index, -1))
+        tempo_at = np.where(last_tempo >= 0, events['tempo'][last_tempo], tempo)
+        if is_tempo.any():
+            tempo = int(events['tempo'][is_tempo][-1])
+        
+        # note_on with velocity 0 is a note_off
+        is_on = (events['type'] == _NOTE_ON) & (events['vel'] > 0)
+        is_off = (events['type'] == _NOTE_OFF) | ((events['type'] == _NOTE_ON) & (events['vel'] == 0))
         
-        for msg in track:
-            current_time += msg.time
-            
-            # Update tempo if found
-            if msg.type == 'set_tempo':
-                tempo = msg.tempo
-            
-            # Track note_on events with velocity
-            elif msg.type == 'note_on' and msg.velocity > 0:
-                active_notes[msg.note] = (current_time, msg.velocity)
-            
-            # Calculate duration on note_off
-            elif (msg.type == 'note_off') or (msg.type == 'note_on' and msg.velocity == 0):
-                if msg.note in active_notes:
-                    start_time, velocity = active_notes[msg.note]
-                    duration_ticks = current_time - start_time
-                    
-                    # Apply tempo override if specified
-                    effective_tempo = tempo
-                    if tempo_override:
-                        # Convert BPM to microseconds per beat
-                        effective_tempo = int(60000000 / tempo_override)
-                    
-                    # Convert ticks to milliseconds using tempo
-                    duration_ms = int((duration_ticks * effective_tempo) / (ticks_per_beat * 1000))
-                    start_ms = int((start_time * effective_tempo) / (ticks_per_beat * 1000))
-                    
-                    freq = int(midi_note_to_frequency(msg.note))
-                    note_name = midi_note_to_name(msg.note)
-                    notes.append((start_ms, freq, duration_ms, note_name, velocity))
-                    
-                    del active_notes[msg.note]
-    
-    # Sort by start time
-    notes.sort(key=lambda x: x[0])
-    
-    # Generate C code
-    c_code = "// Generated MIDI data\n"
-    c_code += f"// Tempo: {tempo} microseconds per beat\n"
-    c_code += f"// Ticks per beat: {ticks_per_beat}\n\n"
-    c_code += "struct Note {\n"
-    c_code += "    unsigned int start_time;  // milliseconds\n"
-    c_code += "    unsigned int frequency;   // Hz\n"
-    c_code += "    unsigned int duration;    // milliseconds\n"
-    c_code += "};\n\n"
-    c_code += f"const struct Note melody[] = {{\n"
-    
-    for start, freq, dur, note_name, velocity in notes:
-        c_code += f"    {{0x{start:04X}, 0x{freq:04X}, 0x{dur:04X}}},  // {note_name}: {start}ms, {freq}Hz, {dur}ms, vel={velocity}\n"
-    
-    c_code += "};\n\n"
-    c_code += f"const int melody_length = {len(notes)};\n"
-    c_code += f"const int tempo = {tempo};\n"
+        # Order note events by pitch, then by position in the track. A note_off
+        # closes a note exactly when the previous event on its pitch is a
+        # note_on: a repeated note_on replaces the pending one, and a
+        # note_off without a pending note_on is ignored
+        note_idx = index[is_on | is_off]
+        note_idx = note_idx[np.lexsort((note_idx, events['note'][note_idx]))]
+        paired = (is_off[note_idx[1:]] & is_on[note_idx[:-1]]
+                  & (events['note'][note_idx[1:]] == events['note'][note_idx[:-1]]))
+        off_idx = note_idx[1:][paired]
+        on_idx = note_idx[:-1][paired]
+        
+        # Emit in note_off order, as notes complete
+        order = np.argsort(off_idx)
+        off_idx, on_idx = off_idx[order], on_idx[order]
+        
+        # Apply tempo override if specified
+        if tempo_override:
+            # Convert BPM to microseconds per beat
+            effective_tempo = np.full(len(off_idx), int(60000000 / tempo_override), dtype=np.int64)
+        else:
+            effective_tempo = tempo_at[off_idx]
+        
+        # Convert ticks to milliseconds using tempo
+        start_ticks = times[on_idx]
+        starts.append((start_ticks * effective_tempo) // (ticks_per_beat * 1000))
+        durations.append(((times[off_idx] - start_ticks) * effective_tempo) // (ticks_per_beat * 1000))
+        pitches.append(events['note'][off_idx])
+        velocities.append(events['vel'][on_idx])
+    
+    # Sort by start time, keeping note_off order for equal starts
+    starts = np.concatenate(starts)
+    order = np.argsort(starts, kind='stable')
+    
+    notes = np.empty(len(starts), dtype=NOTE_DTYPE)
+    notes['start_ms'] = starts[order]
+    notes['dur'] = np.concatenate(durations)[order]
+    notes['note'] = np.concatenate(pitches)[order]
+    notes['vel'] = np.concatenate(velocities)[order]
+    notes['freq'] = _FREQ_TABLE[notes['note']]
+    
+    # Generate C code as a list of fragments joined once at the end
+    parts = ["// Generated MIDI data\n"]
+    parts.append(f"// Tempo: {tempo} microseconds per beat\n")
+    parts.append(f"// Ticks per beat: {ticks_per_beat}\n\n")
+    parts.append("struct Note {\n")
+    parts.append("    unsigned int start_time;  // milliseconds\n")
+    parts.append("    unsigned int frequency;   // Hz\n")
+    parts.append("    unsigned int duration;    // milliseconds\n")
+    parts.append("};\n\n")
+    parts.append(f"const struct Note melody[] = {{\n")
+    
+    # Format every row with a single %-format over the note columns
+    # rather than an f-string per note
+    row = "    {0x%04X, 0x%04X, 0x%04X},  // %s: %dms, %dHz, %dms, vel=%d\n"
+    columns = (notes['start_ms'], notes['freq'], notes['dur'], _NAME_ARRAY[notes['note']],
+               notes['start_ms'], notes['freq'], notes['dur'], notes['vel'])
+    fields = np.empty((len(notes), len(columns)), dtype=object)
+    for i, column in enumerate(columns):
+        fields[:, i] = column
+    parts.append((row * len(notes)) % tuple(fields.ravel().tolist()))
+    
+    parts.append("};\n\n")
+    parts.append(f"const int melody_length = {len(notes)};\n")
+    parts.append(f"const int tempo = {tempo};\n")
+    
+    c_code = "".join(parts)
     
     return c_code, notes
 
+@lru_cache(maxsize=64)
+def _exp_ramp(length, rate):
+    """Return the read-only curve exp(-rate * linspace(0, 1, length))
+
+    The curve is generated by the recurrence y[i] = y[i-1] * r with
+    r = exp(-rate / (length - 1)), i.e. a single cumprod instead of one
+    exp() per sample. Envelope segments of equal length are shared across
+    notes, so it is built once per length.
+    """
+    ramp = np.empty(length, dtype=np.float32)
+    if length > 0:
+        ramp[0] = 1.0
+        ratio = math.exp(-rate / (length - 1)) if length > 1 else 1.0
+        np.cumprod(np.full(length - 1, ratio, dtype=np.float32), out=ramp[1:])
+    ramp.setflags(write=False)
+    return ramp
+
+if njit is not None:
+    @njit("void(float32[:], float64, float64, int64, int64, int64, float64, float64)",
+          cache=True, fastmath=True, nogil=True)
+    def _pluck_kernel(out, frequency, sample_rate, attack_end, decay_end, sustain_end,
+                      sustain_level, gain):
+        """Fill out with the pluck waveform in one fused pass
+
+        Mirrors the NumPy path of generate_nes_pluck: the square level comes
+        from the fixed-point phase counter and the envelope is evaluated
+        per sample from the segment boundaries. Runs without the GIL so
+        play_notes can render several waveforms on a thread pool.
+        """
+        n = out.shape[0]
+        phase_step = np.int64(2.0 * frequency * 4294967296.0 / sample_rate)
+        decay_len = decay_end - attack_end
+        release_len = n - sustain_end
+        for i in range(n):
+            level = 1.0 - 2.0 * ((i * phase_step >> 32) & 1)
+            if i < attack_end:
+                env = i / (attack_end - 1) if attack_end > 1 else 0.0
+            elif i < decay_end:
+                x = (i - attack_end) / (decay_len - 1) if decay_len > 1 else 0.0
+                env = sustain_level + (1.0 - sustain_level) * math.exp(-4.0 * x)
+            elif i < sustain_end:
+                env = sustain_level
+            else:
+                x = (i - sustain_end) / (release_len - 1) if release_len > 1 else 0.0
+                env = sustain_level * math.exp(-3.0 * x)
+            out[i] = level * env * gain
+else:
+    _pluck_kernel = None
+
 def generate_nes_pluck(frequency, duration, sample_rate=44100, amplitude=0.4, velocity=100):
     """Generate a pluck square lead with release tail"""
     # Add release tail to total duration
     release_time = 0.15   # 150ms release tail
     total_duration = duration + release_time
-    
-    t = np.linspace(0, total_duration, int(sample_rate * total_duration), False)
-    
-    # Square wave (50% duty cycle)
-    square = np.sign(np.sin(2 * np.pi * frequency * t))
+    total_samples = int(sample_rate * total_duration)
     
     # Velocity scaling (MIDI velocity 0-127)
     velocity_scale = velocity / 127.0
@@ -105,40 +208,84 @@ def generate_nes_pluck(frequency, duration, sample_rate=44100, amplitude=0.4, ve
     attack_samples = int(attack_time * sample_rate)
     decay_samples = int(decay_time * sample_rate)
     sustain_samples = int(duration * sample_rate) - attack_samples - decay_samples
-    release_samples = int(release_time * sample_rate)
-    total_samples = len(square)
     
-    envelope = np.ones(total_samples)
-    idx = 0
+    # Segment boundaries; a decay or sustain segment that does not fit is
+    # skipped and the release tail covers everything after the last one
+    attack_end = max(attack_samples, 0)
+    decay_end = attack_end
+    if decay_samples > 0 and decay_end + decay_samples <= total_samples:
+        decay_end += decay_samples
+    sustain_end = decay_end
+    if sustain_samples > 0 and sustain_end + sustain_samples <= total_samples:
+        sustain_end += sustain_samples
+    
+    if _pluck_kernel is not None:
+        out = np.empty(total_samples, dtype=np.float32)
+        _pluck_kernel(out, frequency, sample_rate, attack_end, decay_end, sustain_end,
+                      sustain_level, amplitude * velocity_scale)
+        return out
+    
+    # Square wave (50% duty cycle) from a 32.32 fixed-point half-period
+    # counter: bit 32 flips every half cycle, so no sin() is needed
+    phase_step = int(2 * frequency * 2**32 / sample_rate)
+    phase = np.arange(total_samples, dtype=np.int64)
+    phase *= phase_step
+    phase >>= 32
+    phase &= 1
+    
+    # Map bit 0/1 to +1/-1 in place, staying in float32 throughout
+    square = phase.astype(np.float32)
+    square *= np.float32(-2.0)
+    square += np.float32(1.0)
+    
+    # Every sample is written by exactly one segment below, so the buffer
+    # does not need initializing
+    envelope = np.empty(total_samples, dtype=np.float32)
     
     # Fast attack
-    if attack_samples > 0:
-        envelope[idx:idx+attack_samples] = np.linspace(0, 1, attack_samples)
-        idx += attack_samples
+    if attack_end > 0:
+        envelope[:attack_end] = np.linspace(0, 1, attack_end, dtype=np.float32)
     
     # Exponential decay to sustain
-    if decay_samples > 0 and idx + decay_samples <= total_samples:
-        decay_curve = np.exp(-4 * np.linspace(0, 1, decay_samples))
-        decay_curve = sustain_level + (1 - sustain_level) * decay_curve
-        envelope[idx:idx+decay_samples] = decay_curve
-        idx += decay_samples
+    if decay_end > attack_end:
+        decay_curve = envelope[attack_end:decay_end]
+        np.multiply(_exp_ramp(decay_end - attack_end, 4.0), np.float32(1 - sustain_level),
+                    out=decay_curve)
+        decay_curve += np.float32(sustain_level)
     
     # Sustain phase (hold at sustain level)
-    if sustain_samples > 0 and idx + sustain_samples <= total_samples:
-        envelope[idx:idx+sustain_samples] = sustain_level
-        idx += sustain_samples
+    if sustain_end > decay_end:
+        envelope[decay_end:sustain_end] = sustain_level
     
     # Release tail (exponential fade out from sustain level)
-    if idx < total_samples:
-        remaining = total_samples - idx
-        release_curve = np.exp(-3 * np.linspace(0, 1, remaining))
-        envelope[idx:] = sustain_level * release_curve
-    
-    return (square * envelope * amplitude * velocity_scale).astype(np.float32)
+    if sustain_end < total_samples:
+        remaining = total_samples - sustain_end
+        np.multiply(_exp_ramp(remaining, 3.0), np.float32(sustain_level), out=envelope[sustain_end:])
+    
+    # Apply envelope and gain in place on the square buffer
+    np.multiply(square, envelope, out=square)
+    square *= np.float32(amplitude * velocity_scale)
+    return square
+
+@lru_cache(maxsize=512)
+def _cached_pluck(frequency, duration_ms, sample_rate):
+    """Return the read-only full-velocity waveform for one (frequency, duration)
 
-def play_notes(notes):
-    """Play notes using sounddevice with pluck square lead synth"""
-    if not notes:
+    Velocity only scales the waveform, so it is applied at mix time and
+    notes of any velocity share the cached entry.
+    """
+    wave = generate_nes_pluck(frequency, duration_ms / 1000.0, sample_rate, velocity=127)
+    wave.setflags(write=False)
+    return wave
+
+def play_notes(notes, block_size=1024):
+    """Play notes (a NOTE_DTYPE array) using sounddevice with pluck square lead synth
+
+    Audio is mixed block by block in the OutputStream callback, so playback
+    starts immediately and only the voices sounding in the current block
+    are touched.
+    """
+    if len(notes) == 0:
         print("No notes to play")
         return
     
@@ -147,35 +294,91 @@ def play_notes(notes):
     sample_rate = 44100
     
     # Find total duration
-    if notes:
-        total_duration_ms = max(note[0] + note[2] for note in notes)
-        total_samples = int((total_duration_ms / 1000.0) * sample_rate)
-    else:
-        return
-    
-    # Create audio buffer
-    audio_buffer = np.zeros(total_samples, dtype=np.float32)
-    
-    # Generate all notes into buffer with velocity
-    for start_ms, freq, duration, note_name, velocity in notes:
-        if freq > 20 and freq < 20000:
-            start_sample = int((start_ms / 1000.0) * sample_rate)
-            wave = generate_nes_pluck(freq, duration / 1000.0, sample_rate, velocity=velocity)
-            
-            # Mix into buffer
-            end_sample = min(start_sample + len(wave), total_samples)
-            wave_len = end_sample - start_sample
-            audio_buffer[start_sample:end_sample] += wave[:wave_len]
-    
-    # Normalize to prevent clipping
-    max_val = np.max(np.abs(audio_buffer))
-    if max_val > 1.0:
-        audio_buffer = audio_buffer / max_val
+    total_duration_ms = int((notes['start_ms'] + notes['dur']).max())
+    total_samples = int((total_duration_ms / 1000.0) * sample_rate)
+    
+    audible = notes[(notes['freq'] > 20) & (notes['freq'] < 20000)]
+    audible = audible[np.argsort(audible['start_ms'], kind='stable')]
+    start_samples = ((audible['start_ms'] / 1000.0) * sample_rate).astype(np.int64)
+    
+    # Map notes to waveforms: durations are bucketed to 10ms and velocity
+    # is applied at mix time, so repeated pitches hit the same cache entry
+    durations = (audible['dur'] + 5) // 10 * 10
+    gains = audible['vel'] / 127.0
+    keys, wave_index = np.unique(np.stack([audible['freq'], durations], axis=1),
+                                 axis=0, return_inverse=True)
+    wave_index = wave_index.ravel()
+    
+    # Render the unique waveforms concurrently; the Numba kernel releases
+    # the GIL, so this scales with cores
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        waves = list(pool.map(lambda key: _cached_pluck(key[0], key[1], sample_rate),
+                              keys.tolist()))
+    
+    # Prevent clipping without rendering the song first: bound the mix peak
+    # of every block by summing each voice's peak over the blocks it overlaps
+    spreads = []
+    for wave in waves:
+        n_blocks = -(-len(wave) // block_size)
+        padded = np.zeros(n_blocks * block_size, dtype=np.float32)
+        np.abs(wave, out=padded[:len(wave)])
+        peaks = padded.reshape(n_blocks, block_size).max(axis=1)
+        # An unaligned voice block straddles two song blocks
+        spreads.append(np.maximum(np.append(peaks, 0), np.insert(peaks, 0, 0)))
+    
+    bound = np.zeros(total_samples // block_size + max(map(len, spreads), default=0) + 1)
+    for start, index, gain in zip(start_samples.tolist(), wave_index.tolist(), gains.tolist()):
+        first = start // block_size
+        bound[first:first + len(spreads[index])] += spreads[index] * gain
+    
+    headroom = bound.max(initial=0.0)
+    if headroom > 1.0:
+        gains = gains / headroom
+    
+    start_samples = start_samples.tolist()
+    wave_index = wave_index.tolist()
+    gains = gains.tolist()
+    
+    # Active voices as a min-heap of (end, note, start); the next note to
+    # start is tracked by index since notes are sorted by start
+    active = []
+    next_note = 0
+    position = 0
+    finished = threading.Event()
+    
+    def callback(outdata, frames, time_info, status):
+        nonlocal next_note, position
+        block = outdata[:, 0]
+        block.fill(0)
+        block_end = min(position + frames, total_samples)
+        
+        # Add voices starting in this block
+        while next_note < len(start_samples) and start_samples[next_note] < block_end:
+            start = start_samples[next_note]
+            heapq.heappush(active, (start + len(waves[wave_index[next_note]]), next_note, start))
+            next_note += 1
+        
+        # Mix the part of each voice that overlaps this block
+        for end, note, start in active:
+            lo = max(start, position)
+            hi = min(end, block_end)
+            if lo < hi:
+                wave = waves[wave_index[note]]
+                block[lo - position:hi - position] += wave[lo - start:hi - start] * gains[note]
+        
+        # Drop voices that ended within this block
+        while active and active[0][0] <= block_end:
+            heapq.heappop(active)
+        
+        position = block_end
+        if position >= total_samples:
+            raise sd.CallbackStop
     
     # Stream play
     print(f"Streaming {total_duration_ms/1000.0:.2f} seconds of audio...")
-    sd.play(audio_buffer, sample_rate)
-    sd.wait()
+    with sd.OutputStream(samplerate=sample_rate, blocksize=block_size, channels=1,
+                         dtype='float32', callback=callback, finished_callback=finished.set):
+        finished.wait()
     
     print(f"Playback completed!")
 
@@ -1,6 +1,7 @@
 import json
 import re
 import sys
+from collections import ChainMap
 from pathlib import Path
 
 
@@ -23,6 +24,10 @@ def parse_value(value):
         return value
 
 
+# key= followed by a value that runs (spaces included) up to the next key=
+_OPCODE_RE = re.compile(r"([^\s=]+)=(.*?)(?=\s+[\w$]+=|$)")
+
+
 def extract_opcodes(line):
     """
     Robust opcode extractor.
@@ -30,32 +35,7 @@ def extract_opcodes(line):
     Example:
     sample=Mf B-1.$EXT
     """
-    tokens = []
-    i = 0
-    length = len(line)
-
-    while i < length:
-        eq = line.find("=", i)
-        if eq == -1:
-            break
-
-        # find key
-        key_start = line.rfind(" ", 0, eq)
-        key = line[key_start+1:eq].strip()
-
-        # find next key=
-        next_match = re.search(r"\s+\w+=", line[eq+1:])
-        if next_match:
-            value_end = eq + 1 + next_match.start()
-            value = line[eq+1:value_end]
-            i = value_end
-        else:
-            value = line[eq+1:]
-            i = length
-
-        tokens.append((key, value.strip()))
-
-    return tokens
+    return [(m.group(1), m.group(2).strip()) for m in _OPCODE_RE.finditer(line)]
 
 
 # -----------------------------
@@ -72,12 +52,23 @@ class SFZParser:
         }
 
         self.defines = {}
+        self._defines_re = None
+        self._defines_dirty = False
         self.current_section = None
         self.current_group = None
         self.current_region = None
         self.verbose = verbose
         self.processed_files = set()  # Track processed files to avoid circular includes
 
+        # Section headers and the handler for each
+        self.section_handlers = {
+            "<control>": self._enter_control,
+            "<global>": self._enter_global,
+            "<master>": self._enter_group,  # master is like a group
+            "<group>": self._enter_group,
+            "<region>": self._enter_region,
+        }
+
     # -----------------------------
     # Recursive file parsing
     # -----------------------------
@@ -104,6 +95,35 @@ class SFZParser:
             for raw_line in f:
                 self.process_line(raw_line.strip(), filepath.parent)
 
+    # -----------------------------
+    # Macro expansion
+    # -----------------------------
+
+    def _expand(self, value, expanding=frozenset()):
+        """Replace $macro references in value using one compiled pattern
+
+        Macro values are expanded in turn, so $A defined as $B resolves
+        through $B; a macro is never re-expanded inside its own value.
+        """
+        if not self.defines or "$" not in value:
+            return value
+
+        if self._defines_dirty:
+            # longest names first so $EXTRA is not matched as $EXT
+            names = sorted(self.defines, key=len, reverse=True)
+            self._defines_re = re.compile(
+                r"\$(" + "|".join(map(re.escape, names)) + ")"
+            )
+            self._defines_dirty = False
+
+        def replace(match):
+            name = match.group(1)
+            if name in expanding:
+                return match.group(0)
+            return self._expand(self.defines[name], expanding | {name})
+
+        return self._defines_re.sub(replace, value)
+
     # -----------------------------
     # Line processor
     # -----------------------------
@@ -120,6 +140,16 @@ class SFZParser:
         if "//" in line:
             line = line.split("//")[0].strip()
 
+        # -------------------------
+        # Section switching
+        # -------------------------
+        if line.startswith("<"):
+            tag = line[:line.find(">") + 1]
+            handler = self.section_handlers.get(tag)
+            if handler:
+                handler(line[len(tag):].strip())
+                return
+
         # -------------------------
         # #define
         # -------------------------
@@ -128,6 +158,7 @@ class SFZParser:
             if match:
                 key, value = match.groups()
                 self.defines[key] = value.strip()
+                self._defines_dirty = True
                 if self.verbose:
                     print(f"[DEFINE] ${key} = {value.strip()}")
             return
@@ -141,8 +172,7 @@ class SFZParser:
                 include_path = match.group(1)
 
                 # macro replacement
-                for macro, val in self.defines.items():
-                    include_path = include_path.replace(f"${macro}", val)
+                include_path = self._expand(include_path)
 
                 include_path = include_path.replace("\\", "/")
                 include_file = (base_path / include_path).resolve()
@@ -155,68 +185,6 @@ class SFZParser:
                     print(f"[ERROR] Include file not found: {include_file}")
             return
 
-        # -------------------------
-        # Section switching
-        # -------------------------
-        if line.startswith("<control>"):
-            self.current_section = "control"
-            return
-
-        if line.startswith("<global>"):
-            self.current_section = "global"
-            return
-
-        if line.startswith("<master>"):
-            # Master is like a group
-            self.current_section = "group"
-            self.current_group = {
-                "opcodes": {},
-                "regions": []
-            }
-            self.data["groups"].append(self.current_group)
-            self.current_region = None
-            return
-
-        if line.startswith("<group>"):
-            self.current_section = "group"
-            self.current_group = {
-                "opcodes": {},
-                "regions": []
-            }
-            self.data["groups"].append(self.current_group)
-            self.current_region = None
-            return
-
-        if line.startswith("<region>"):
-            self.current_section = "region"
-
-            if self.current_group is None:
-                self.current_group = {
-                    "opcodes": {},
-                    "regions": []
-                }
-                self.data["groups"].append(self.current_group)
-
-            region = {}
-            region.update(self.data["global"])
-            region.update(self.current_group["opcodes"])
-
-            self.current_group["regions"].append(region)
-            self.current_region = region
-            
-            # Parse opcodes on the same line as <region>
-            rest_of_line = line[8:].strip()  # Remove "<region>" prefix
-            if rest_of_line and "=" in rest_of_line:
-                opcodes = extract_opcodes(rest_of_line)
-                for key, value in opcodes:
-                    # macro replace inside value
-                    for macro, val in self.defines.items():
-                        value = value.replace(f"${macro}", val)
-                    value = parse_value(value)
-                    self.current_region[key] = value
-            
-            return
-
         # -------------------------
         # Opcode parsing
         # -------------------------
@@ -226,10 +194,7 @@ class SFZParser:
             for key, value in opcodes:
 
                 # macro replace inside value
-                for macro, val in self.defines.items():
-                    value = value.replace(f"${macro}", val)
-
-                value = parse_value(value)
+                value = parse_value(self._expand(value))
 
                 if self.current_section == "control":
                     self.data["control"][key] = value
@@ -243,6 +208,53 @@ class SFZParser:
                 elif self.current_section == "region" and self.current_region:
                     self.current_region[key] = value
 
+    # -----------------------------
+    # Section handlers
+    # -----------------------------
+
+    def _enter_control(self, rest_of_line):
+        self.current_section = "control"
+
+    def _enter_global(self, rest_of_line):
+        self.current_section = "global"
+
+        # Regions chain to the global dict instead of copying it, so start
+        # a new one to keep earlier regions from seeing later opcodes
+        self.data["global"] = dict(self.data["global"])
+
+    def _enter_group(self, rest_of_line):
+        self.current_section = "group"
+        self.current_group = {
+            "opcodes": {},
+            "regions": []
+        }
+        self.data["groups"].append(self.current_group)
+        self.current_region = None
+
+    def _enter_region(self, rest_of_line):
+        self.current_section = "region"
+
+        if self.current_group is None:
+            self.current_group = {
+                "opcodes": {},
+                "regions": []
+            }
+            self.data["groups"].append(self.current_group)
+
+        # Inherit group and global opcodes by reference rather than copy
+        region = ChainMap({}, self.current_group["opcodes"], self.data["global"])
+
+        self.current_group["regions"].append(region)
+        self.current_region = region
+
+        # Parse opcodes on the same line as <region>
+        if rest_of_line and "=" in rest_of_line:
+            opcodes = extract_opcodes(rest_of_line)
+            for key, value in opcodes:
+                # macro replace inside value
+                value = parse_value(self._expand(value))
+                self.current_region[key] = value
+
     # -----------------------------
     # Normalize
     # -----------------------------
@@ -256,15 +268,23 @@ class SFZParser:
 
         default_path = self.data["control"].get("default_path", "")
 
+        # parse default_path once rather than once per region
+        sample_root = Path(default_path)
+
         region_count = 0
         for group in self.data["groups"]:
             for region in group["regions"]:
 
+                # flatten the inheritance chain once for the lookups below;
+                # a dict merge is much cheaper than dict(ChainMap)
+                overrides, group_opcodes, global_opcodes = region.maps
+                region = {**global_opcodes, **group_opcodes, **overrides}
+
                 sample = region.get("sample", None)
 
                 # prepend default_path if exists
                 if sample and default_path:
-                    sample = str(Path(default_path) / sample).replace("\\", "/")
+                    sample = str(sample_root / sample).replace("\\", "/")
                 elif sample:
                     sample = sample.replace("\\", "/")
 
@@ -6,6 +6,7 @@ Verify that sample files referenced in JSON exist
 import json
 import os
 import sys
+from collections import defaultdict
 
 def verify_json_samples(json_path):
     """Check if all sample files in JSON exist"""
@@ -21,6 +22,10 @@ def verify_json_samples(json_path):
     unique_samples = set()
     missing_samples = []
     
+    # Bucket samples by parent directory so each directory is listed once
+    # instead of stat()ing every file
+    buckets = defaultdict(list)
+    
     for i, region in enumerate(regions):
         sample = region.get('sample')
         if not sample:
@@ -31,11 +36,33 @@ def verify_json_samples(json_path):
         
         # Build full path
         full_path = os.path.join(base_dir, sample)
+        parent, name = os.path.split(full_path)
+        buckets[parent].append((i, name, sample, full_path))
+    
+    missing = []
+    for parent, entries in buckets.items():
+        try:
+            with os.scandir(parent or '.') as it:
+                listed = {entry.name: entry for entry in it}
+        except OSError:
+            listed = {}
         
-        if not os.path.exists(full_path):
-            missing_samples.append(sample)
-            if len(missing_samples) <= 5:  # Only print first 5
-                print(f"  Missing: {sample}")
+        for i, name, sample, full_path in entries:
+            entry = listed.get(name)
+            if entry is not None and not entry.is_symlink():
+                continue
+            
+            # The listing is exact and case-sensitive; confirm names not in
+            # it (case-insensitive filesystems) and symlinks (which may be
+            # broken) with os.path.exists
+            if not os.path.exists(full_path):
+                missing.append((i, sample))
+    
+    # Report in region order
+    for i, sample in sorted(missing):
+        missing_samples.append(sample)
+        if len(missing_samples) <= 5:  # Only print first 5
+            print(f"  Missing: {sample}")
     
     print(f"\nSummary:")
     print(f"  Total regions: {len(regions)}")